@@ -1,10 +1,33 @@
 import os
+import re
+import io
+import csv
 import json
 import time
-from typing import Dict, Any
-
+import random
+import asyncio
+import logging
+import sqlite3
+import hashlib
+import argparse
+import unicodedata
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+import orjson
 import pandas as pd
-from openai import OpenAI
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from openai import APIStatusError, AsyncOpenAI
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+try:  # optional: only needed for --semantic-cache
+    import faiss
+    import numpy as np
+except ImportError:
+    faiss = None
 
 # ----------------------------
 # Config
@@ -17,10 +40,46 @@ META_COLS = ["SenderScreenName", "CreatedTime", "MessageType", "Country", "State
 
 OUTPUT_JSONL = "topics.jsonl"
 OUTPUT_CSV = "topics.csv"
+TOPIC_LOOKUP_CSV = "topic_lookup.csv"
+ANALYSIS_FIELDS = [
+    "topic_id",
+    "topic",
+    "subtopic",
+    "confidence",
+    "rationale",
+    "newSentiment",
+    "newSentimentConfidence",
+]
 
 MAX_CHARS_PER_POST = 2000
-SLEEP_BETWEEN_CALLS_SEC = 0.2
+MAX_CONCURRENT_CALLS = 32        # in-flight API requests
+MAX_REQUESTS_PER_MINUTE = 500    # token-bucket cap on realtime request starts (match your RPM tier)
+CHUNK_SIZE = 256                 # rows gathered per round before writing output
+MESSAGES_PER_REQUEST = 10        # messages classified together in one prompt
 MAX_RETRIES = 5
+MAX_ERROR_LOGS_PER_MIN = 20      # further per-row ERROR lines in the same minute are dropped
+
+# Batch API (default mode; pass --realtime for per-request calls)
+BATCH_INPUT_JSONL = "batch_input.jsonl"
+BATCH_MAX_REQUESTS = 50000       # OpenAI per-batch request limit
+BATCH_MAX_BYTES = 190 * 1024 * 1024  # stay under the 200 MB batch input file limit
+BATCH_POLL_SEC = 30
+BATCH_STATE_JSON = "batch_state.json"  # submitted, not yet collected batches (re-attached on restart)
+
+CACHE_DB = "cache.sqlite"        # exact-match response cache, reused across runs
+
+# Pre-filter: short rows with none of these keywords skip the LLM and are labelled Other / Unclear
+PRE_FILTER = re.compile(
+    r"\b(?:resolutions?|goals?|new year|next year|20\d{2}|quit|start|stop|lose|gain|save)\b", re.I
+)
+PRE_FILTER_MIN_CHARS = 40
+
+# Semantic cache (opt-in via --semantic-cache; requires faiss-cpu)
+EMBED_MODEL = "text-embedding-3-small"
+EMBED_DIM = 1536
+EMBED_BATCH_SIZE = 256
+SEMANTIC_THRESHOLD = 0.93        # cosine similarity needed to reuse a neighbour's result
+SEMANTIC_CACHE_PREFIX = "semantic_cache"  # files are <prefix>.<config hash>.faiss / .json
 
 # ----------------------------
 # Locked taxonomy (topics)
@@ -45,18 +104,41 @@ TOPICS = [
 TOPIC_NAME_TO_ID = {t["topic"]: t["topic_id"] for t in TOPICS}
 ALLOWED_TOPICS = list(TOPIC_NAME_TO_ID.keys())
 OTHER_TOPIC = "Other / Unclear"
+OTHER_TOPIC_ID = TOPIC_NAME_TO_ID[OTHER_TOPIC]
+ALLOWED_TOPICS_SET = frozenset(TOPIC_NAME_TO_ID)
+
+
+def _topics_csv_bytes() -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(["topic_id", "topic"])
+    writer.writerows((t["topic_id"], t["topic"]) for t in TOPICS)
+    return buf.getvalue().encode("utf-8-sig")
+
+
+TOPICS_CSV_BYTES = _topics_csv_bytes()
 
 # ----------------------------
 # Locked taxonomy (sentiment)
 # ----------------------------
 ALLOWED_SENTIMENT = ["Positive", "Negative", "Neutral", "Mixed", "Unclear"]
+ALLOWED_SENT_SET = frozenset(ALLOWED_SENTIMENT)
+
+PRE_FILTER_RESULT = {
+    "topic": OTHER_TOPIC,
+    "subtopic": None,
+    "confidence": 0.2,
+    "rationale": "Short message with no resolution keywords (pre-filtered).",
+    "newSentiment": "Unclear",
+    "newSentimentConfidence": 0.2,
+}
 
 SYSTEM_PROMPT = f"""You are a social media text analyst.
 
 Task:
 1) I need to analyse what are the top resolutions that people make. You will receive unfiltered raw Reddit messages that contain the keyword "new year resolution". 
-2) Classify ONE social media message into EXACTLY ONE topic bucket from the locked list.
-3) Assign a NEW sentiment label for the message (ignore any existing vendor sentiment).
+2) You will receive a JSON object whose "messages" array holds up to {MESSAGES_PER_REQUEST} social media messages. Classify EACH message into EXACTLY ONE topic bucket from the locked list.
+3) Assign a NEW sentiment label for each message (ignore any existing vendor sentiment).
 
 Locked topic buckets (choose exactly one string, match spelling/case exactly):
 {json.dumps(ALLOWED_TOPICS, ensure_ascii=False)}
@@ -64,40 +146,155 @@ Locked topic buckets (choose exactly one string, match spelling/case exactly):
 Locked sentiment labels (choose exactly one string, match spelling/case exactly):
 {json.dumps(ALLOWED_SENTIMENT, ensure_ascii=False)}
 
-Return ONLY valid JSON with this schema:
-{{
-  "topic": string,                  // must be one of the locked topic buckets exactly
-  "subtopic": string|null,          // optional refinement (free text)
-  "confidence": number,             // topic confidence 0 to 1
-  "rationale": string,              // <= 20 words
-  "newSentiment": string,           // must be one of the locked sentiment labels exactly
-  "newSentimentConfidence": number  // 0 to 1
-}}
-
 Rules:
+- Return exactly one result per message, in the same order as "messages".
+- "subtopic" is an optional free-text refinement (null if none); "rationale" is at most 20 words.
+- Classify each message independently; never let one message influence another's labels.
 - If the message is mostly noise, sarcasm, too vague, or you cannot decide: use "{OTHER_TOPIC}" and sentiment "Unclear" with low confidence. This includes messages that do not have clear indication of a new year resolution. Do not infer.
 - Do not invent new labels outside the locked lists.
 - Pick the dominant intent if multiple goals appear.
 """
 
-client = OpenAI()  # reads OPENAI_API_KEY from environment
+# Structured Outputs schema: the API guarantees responses parse and use the locked labels
+CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "topic": {"type": "string", "enum": ALLOWED_TOPICS},
+        "subtopic": {"type": ["string", "null"]},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "rationale": {"type": "string"},
+        "newSentiment": {"type": "string", "enum": ALLOWED_SENTIMENT},
+        "newSentimentConfidence": {"type": "number", "minimum": 0, "maximum": 1},
+    },
+    "required": [
+        "topic",
+        "subtopic",
+        "confidence",
+        "rationale",
+        "newSentiment",
+        "newSentimentConfidence",
+    ],
+    "additionalProperties": False,
+}
+RESULTS_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": CLASSIFICATION_SCHEMA}},
+    "required": ["results"],
+    "additionalProperties": False,
+}
+SCHEMA_JSON = json.dumps(RESULTS_SCHEMA, sort_keys=True)
+TEXT_FORMAT = {
+    "format": {
+        "type": "json_schema",
+        "name": "Classifications",
+        "schema": RESULTS_SCHEMA,
+        "strict": True,
+    }
+}
+
+# Built once and sent byte-identical on every call so OpenAI's automatic prompt caching applies
+# (the JSON shape is enforced by TEXT_FORMAT, so the prompt doesn't restate it)
+FULL_SYSTEM = SYSTEM_PROMPT
+
+client = AsyncOpenAI(max_retries=0)  # reads OPENAI_API_KEY from environment; call_with_retries owns retries
+
+logger = logging.getLogger("sociallistening")
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop ERROR records beyond `limit` per `window` seconds so a burst of failures can't flood the console."""
+
+    def __init__(self, limit: int, window: float = 60.0):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.window_start = 0.0
+        self.count = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.ERROR:
+            return True  # progress lines are never dropped
+        if record.created - self.window_start >= self.window:
+            self.window_start = record.created
+            self.count = 0
+        self.count += 1
+        return self.count <= self.limit
+
+
+def trim_column(texts: pd.Series) -> pd.Series:
+    """Strip every message and cap it at MAX_CHARS_PER_POST (adding "…"), using Arrow kernels."""
+    arr = pc.utf8_trim_whitespace(pa.array(texts, type=pa.string()))
+    too_long = pc.greater(pc.utf8_length(arr), MAX_CHARS_PER_POST)
+    cut = pc.utf8_rtrim_whitespace(pc.utf8_slice_codeunits(arr, 0, MAX_CHARS_PER_POST))
+    trimmed = pc.if_else(too_long, pc.binary_join_element_wise(cut, "…", ""), arr)
+    return pd.Series(pd.arrays.ArrowExtensionArray(trimmed), index=texts.index)
+
+
+class RateLimiter:
+    """Async token bucket: at most `rate` acquisitions per `period` seconds, with bursts up to `rate`."""
+
+    def __init__(self, rate: float, period: float = 60.0):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
 
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.fill_rate)
 
-def trim_text(text: str) -> str:
-    text = (text or "").strip()
-    if len(text) <= MAX_CHARS_PER_POST:
-        return text
-    return text[:MAX_CHARS_PER_POST].rstrip() + "…"
 
+rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE)
 
-def call_with_retries(fn, max_retries: int = MAX_RETRIES, base_delay: float = 1.0):
+
+_RESET_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_RESET_UNIT_SEC = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _retry_after_seconds(e: APIStatusError) -> float:
+    """Wait the server asked for: Retry-After (seconds) or x-ratelimit-reset-* (e.g. "1.5s", "6m0s")."""
+    headers = e.response.headers
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, ValueError):
+        pass  # absent or HTTP-date form; fall back to the reset headers / exponential delay
+    wait = 0.0
+    for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        reset = headers.get(name)
+        if reset:
+            secs = sum(float(n) * _RESET_UNIT_SEC[u] for n, u in _RESET_DURATION_RE.findall(reset))
+            wait = max(wait, secs)
+    return wait
+
+
+def _is_retryable_status(status: int) -> bool:
+    # Timeouts, conflicts, rate limits and server errors; other 4xx won't succeed on a re-send
+    return status in (408, 409, 429) or status >= 500
+
+
+async def call_with_retries(fn, max_retries: int = MAX_RETRIES, base_delay: float = 1.0):
     for attempt in range(max_retries):
         try:
-            return fn()
+            return await fn()
+        except APIStatusError as e:  # includes RateLimitError (429)
+            if attempt == max_retries - 1 or not _is_retryable_status(e.status_code):
+                raise
+            backoff = base_delay * (2 ** attempt)
+            # Honor the server's hint, never retry sooner than the exponential delay, add jitter
+            delay = max(_retry_after_seconds(e), backoff) + random.uniform(0, 0.25 * backoff)
+            await asyncio.sleep(delay)
+        except ResultCountMismatch:
+            raise  # not transient: callers fall back to one message per request instead
         except Exception:
             if attempt == max_retries - 1:
                 raise
-            time.sleep(base_delay * (2 ** attempt))
+            await asyncio.sleep(base_delay * (2 ** attempt))
 
 
 def _to_float_clamped(x: Any) -> float:
@@ -113,40 +310,33 @@ def _to_float_clamped(x: Any) -> float:
 
 
 def validate_and_normalize(result: Dict[str, Any]) -> Dict[str, Any]:
-    # ---- topic ----
+    # topic / newSentiment are in-enum under Structured Outputs; the O(1) set checks are a cheap guard
     topic = result.get("topic")
-    if topic not in TOPIC_NAME_TO_ID:
-        topic = OTHER_TOPIC
+    if isinstance(topic, str) and topic in ALLOWED_TOPICS_SET:
+        topic_id = TOPIC_NAME_TO_ID[topic]
+    else:
+        topic, topic_id = OTHER_TOPIC, OTHER_TOPIC_ID
 
-    subtopic = result.get("subtopic", None)
-    if subtopic is not None and not isinstance(subtopic, str):
-        subtopic = str(subtopic)
-    subtopic = subtopic.strip() if isinstance(subtopic, str) else None
-    if not subtopic:
-        subtopic = None
+    subtopic = result.get("subtopic")
+    subtopic = (str(subtopic).strip() or None) if subtopic is not None else None
 
     confidence = _to_float_clamped(result.get("confidence", 0.0))
 
-    rationale = result.get("rationale", "")
-    if not isinstance(rationale, str):
-        rationale = str(rationale)
-    rationale = rationale.strip()
+    rationale = str(result.get("rationale", "")).strip()
     if len(rationale) > 120:
         rationale = rationale[:120].rstrip() + "…"
 
-    # ---- sentiment ----
     new_sent = result.get("newSentiment")
-    if new_sent not in ALLOWED_SENTIMENT:
+    if not (isinstance(new_sent, str) and new_sent in ALLOWED_SENT_SET):
         new_sent = "Unclear"
-
     new_sent_conf = _to_float_clamped(result.get("newSentimentConfidence", 0.0))
 
     # If topic is Other/Unclear, nudge sentiment confidence down if it's oddly high
-    if topic == OTHER_TOPIC and new_sent_conf > 0.7:
+    if topic_id == OTHER_TOPIC_ID and new_sent_conf > 0.7:
         new_sent_conf = 0.7
 
     return {
-        "topic_id": TOPIC_NAME_TO_ID[topic],
+        "topic_id": topic_id,
         "topic": topic,
         "subtopic": subtopic,
         "confidence": confidence,
@@ -156,46 +346,550 @@ def validate_and_normalize(result: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
-def analyze_message(message: str) -> Dict[str, Any]:
-    message = trim_text(message)
-
-    def _do_call():
-        resp = client.responses.create(
-            model="gpt-5-mini",
-            input=[
-                {
-                    "role": "system",
-                    "content": SYSTEM_PROMPT
-                    + "\n\nIMPORTANT: Respond with ONLY valid JSON. No markdown. No explanation."
-                },
-                {"role": "user", "content": message},
-            ],
+def build_request_body(messages: List[str]) -> Dict[str, Any]:
+    """Responses API request body, shared by the realtime and Batch API paths."""
+    return {
+        "model": MODEL,
+        "instructions": FULL_SYSTEM,
+        "input": [{"role": "user", "content": orjson.dumps({"messages": messages}).decode("utf-8")}],
+        "text": TEXT_FORMAT,
+    }
+
+
+class ResultCountMismatch(ValueError):
+    """The model returned the wrong number of results; re-sending the same prompt rarely helps."""
+
+
+def parse_output_text(raw_text: str, expected: int) -> List[Dict[str, Any]]:
+    results = orjson.loads(raw_text)["results"]
+    if len(results) != expected:
+        raise ResultCountMismatch(f"Model returned {len(results)} results for {expected} messages")
+    return [validate_and_normalize(r) for r in results]
+
+
+async def analyze_message(messages: List[str]) -> List[Dict[str, Any]]:
+    body = build_request_body(messages)
+
+    async def _do_call():
+        await rate_limiter.acquire()
+        resp = await client.responses.create(**body)
+        return parse_output_text(resp.output_text, len(messages))
+
+    return await call_with_retries(_do_call)
+
+
+async def analyze_async(messages: List[str], sem: asyncio.Semaphore) -> List[Dict[str, Any]]:
+    async with sem:
+        return await analyze_message(messages)
+
+
+async def analyze_singly(messages: List[str], sem: asyncio.Semaphore) -> List[Any]:
+    """Fallback for a failed group: one request per message, so one bad message can't sink the rest."""
+    outcomes = await asyncio.gather(*[analyze_async([m], sem) for m in messages], return_exceptions=True)
+    return [o if isinstance(o, Exception) else o[0] for o in outcomes]
+
+
+async def analyze_chunk(messages: List[str], sem: asyncio.Semaphore) -> List[Any]:
+    """Analyze messages concurrently; results (or exceptions) come back in input order."""
+    groups = [
+        messages[i : i + MESSAGES_PER_REQUEST] for i in range(0, len(messages), MESSAGES_PER_REQUEST)
+    ]
+    outcomes = await asyncio.gather(*[analyze_async(g, sem) for g in groups], return_exceptions=True)
+
+    results: List[Any] = []
+    for group, outcome in zip(groups, outcomes):
+        if isinstance(outcome, Exception):
+            outcome = await analyze_singly(group, sem) if len(group) > 1 else [outcome]
+        results.extend(outcome)
+    return results
+
+
+# ----------------------------
+# Batch API
+# ----------------------------
+def _output_text_from_body(body: Dict[str, Any]) -> str:
+    """Raw Responses JSON has no output_text convenience field; join the message text parts."""
+    parts = []
+    for item in body.get("output") or []:
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content") or []:
+            if content.get("type") == "output_text":
+                parts.append(content.get("text") or "")
+    return "".join(parts)
+
+
+def _parse_batch_line(line: Dict[str, Any], expected: int) -> Any:
+    if line.get("error"):
+        return RuntimeError(f"Batch request failed: {line['error']}")
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        return RuntimeError(
+            f"Batch request failed with HTTP {response.get('status_code')}: {response.get('body')}"
+        )
+    try:
+        return parse_output_text(_output_text_from_body(response.get("body") or {}), expected)
+    except Exception as e:
+        return e
+
+
+async def _read_batch_file(file_id: str, lines: Dict[str, Any]):
+    content = await call_with_retries(lambda: client.files.content(file_id))
+    for line in content.content.splitlines():
+        if line.strip():
+            rec = orjson.loads(line)
+            lines[rec["custom_id"]] = rec
+
+
+def _load_batch_state() -> Dict[str, Dict[str, List[str]]]:
+    """batch id -> {custom_id: cache keys of the messages in that request}."""
+    if not os.path.exists(BATCH_STATE_JSON):
+        return {}
+    with open(BATCH_STATE_JSON, "rb") as f:
+        return orjson.loads(f.read())
+
+
+def _save_batch_state(state: Dict[str, Dict[str, List[str]]]):
+    if not state:
+        if os.path.exists(BATCH_STATE_JSON):
+            os.remove(BATCH_STATE_JSON)
+        return
+    tmp_path = BATCH_STATE_JSON + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(state))
+    os.replace(tmp_path, BATCH_STATE_JSON)
+
+
+def _batch_request_line(custom_id: str, messages: List[str]) -> bytes:
+    req = {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/responses",
+        "body": build_request_body(messages),
+    }
+    return orjson.dumps(req) + b"\n"
+
+
+async def _submit_batch(lines: List[bytes]) -> str:
+    with open(BATCH_INPUT_JSONL, "wb", buffering=1 << 20) as f:
+        f.writelines(lines)
+
+    async def _upload():
+        with open(BATCH_INPUT_JSONL, "rb") as f:
+            return await client.files.create(file=f, purpose="batch")
+
+    uploaded = await call_with_retries(_upload)
+    # Uploaded; the local copy (up to ~200 MB of message text) is no longer needed
+    os.remove(BATCH_INPUT_JSONL)
+    batch = await call_with_retries(
+        lambda: client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/responses",
+            completion_window="24h",
+        )
+    )
+    logger.info(f"Submitted batch {batch.id} ({len(lines)} requests)")
+    return batch.id
+
+
+def _batch_errors_text(batch) -> str:
+    """Batch-level errors (e.g. input file validation) as one line; empty if there are none."""
+    errors = getattr(batch.errors, "data", None) or []
+    return "; ".join(
+        f"{e.code}: {e.message}" + (f" (line {e.line})" if e.line is not None else "") for e in errors
+    )
+
+
+async def _collect_batch(
+    batch_id: str, groups: Dict[str, List[str]]
+) -> Tuple[Dict[str, Any], List[str]]:
+    """Wait for a batch to end; returns cache key -> analysis (or exception) for every message in it,
+    plus the custom_ids of requests that came back failed (as opposed to missing)."""
+    while True:
+        batch = await call_with_retries(lambda: client.batches.retrieve(batch_id))
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        counts = batch.request_counts
+        done = f" {counts.completed + counts.failed}/{counts.total}" if counts else ""
+        logger.info(f"Batch {batch_id}: {batch.status}{done}")
+        await asyncio.sleep(BATCH_POLL_SEC)
+
+    # Expired / cancelled batches still carry the requests that finished; keep those
+    lines: Dict[str, Any] = {}
+    if batch.output_file_id:
+        await _read_batch_file(batch.output_file_id, lines)
+    if batch.error_file_id:
+        await _read_batch_file(batch.error_file_id, lines)
+    reason = _batch_errors_text(batch)
+    reason = f": {reason}" if reason else ""
+    if batch.status != "completed":
+        logger.warning(
+            f"Batch {batch_id} ended with status '{batch.status}'{reason}; "
+            f"keeping {len(lines)}/{len(groups)} returned requests"
         )
 
-        raw_text = (resp.output_text or "").strip()
+    results: Dict[str, Any] = {}
+    failed: List[str] = []
+    missing = RuntimeError(
+        f"Missing from output of batch {batch_id} (status '{batch.status}'){reason}"
+    )
+    for custom_id, keys in groups.items():
+        line = lines.get(custom_id)
+        outcome = missing if line is None else _parse_batch_line(line, len(keys))
+        if isinstance(outcome, Exception):
+            if line is not None:
+                failed.append(custom_id)
+            outcome = [outcome] * len(keys)
+        results.update(zip(keys, outcome))
+    return results, failed
+
+
+async def _collect_and_cache(
+    batch_id: str, state: Dict[str, Dict[str, List[str]]], cache: "LLMCache"
+) -> Tuple[Dict[str, Any], List[str]]:
+    # Cache each batch as soon as it's collected so a later failure can't lose paid-for results
+    results, failed = await _collect_batch(batch_id, state[batch_id])
+    for key, analysis in results.items():
+        if not isinstance(analysis, Exception):
+            cache.set(key, analysis)
+    cache.commit()
+    del state[batch_id]
+    _save_batch_state(state)
+    return results, failed
+
+
+async def recover_batches(cache: "LLMCache"):
+    """Collect batches submitted by an interrupted run, so their results land in the cache."""
+    state = _load_batch_state()
+    for batch_id in list(state):
+        logger.info(f"Re-attaching to batch {batch_id} from a previous run")
+        await _collect_and_cache(batch_id, state, cache)
+
+
+async def run_batch(keys: List[str], messages: List[str], cache: "LLMCache") -> Dict[str, Any]:
+    """Submit messages through the Batch API; returns cache key -> analysis (or exception)."""
+    # One request per MESSAGES_PER_REQUEST messages
+    groups = [
+        (
+            f"group-{n}",
+            keys[i : i + MESSAGES_PER_REQUEST],
+            messages[i : i + MESSAGES_PER_REQUEST],
+        )
+        for n, i in enumerate(range(0, len(messages), MESSAGES_PER_REQUEST))
+    ]
+
+    state = _load_batch_state()
+    batch_ids = []
+
+    async def submit(part: Dict[str, List[str]], lines: List[bytes]):
+        batch_id = await _submit_batch(lines)
+        # Persist right away: an interrupted wait re-attaches instead of re-submitting (and re-paying)
+        state[batch_id] = part
+        _save_batch_state(state)
+        batch_ids.append(batch_id)
+
+    # Split into batch files by request count and by size
+    part: Dict[str, List[str]] = {}
+    lines: List[bytes] = []
+    size = 0
+    for custom_id, group_keys, group_msgs in groups:
+        line = _batch_request_line(custom_id, group_msgs)
+        if lines and (len(lines) >= BATCH_MAX_REQUESTS or size + len(line) > BATCH_MAX_BYTES):
+            await submit(part, lines)
+            part, lines, size = {}, [], 0
+        part[custom_id] = group_keys
+        lines.append(line)
+        size += len(line)
+    if lines:
+        await submit(part, lines)
+
+    results: Dict[str, Any] = {}
+    failed: List[str] = []
+    for batch_id in batch_ids:
+        batch_results, batch_failed = await _collect_and_cache(batch_id, state, cache)
+        results.update(batch_results)
+        failed.extend(batch_failed)
+
+    # Requests that came back failed (refusal, wrong result count) get one retry per message
+    failed_ids = set(failed)
+    retry = [
+        (key, msg)
+        for custom_id, group_keys, group_msgs in groups
+        if custom_id in failed_ids and len(group_keys) > 1
+        for key, msg in zip(group_keys, group_msgs)
+    ]
+    if retry:
+        logger.info(f"Re-sending {len(retry)} messages from failed batch requests one per request")
+        sem = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+        outcomes = await analyze_singly([m for _, m in retry], sem)
+        for (key, _), analysis in zip(retry, outcomes):
+            if not isinstance(analysis, Exception):
+                cache.set(key, analysis)
+            results[key] = analysis
+        cache.commit()
+    return results
 
-        # Defensive JSON extraction (handles rare leading/trailing text)
-        try:
-            raw = json.loads(raw_text)
-        except json.JSONDecodeError:
-            start = raw_text.find("{")
-            end = raw_text.rfind("}")
-            if start == -1 or end == -1 or end <= start:
-                raise
-            raw = json.loads(raw_text[start : end + 1])
 
-        return validate_and_normalize(raw)
+# ----------------------------
+# Response cache
+# ----------------------------
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_message(text: str) -> str:
+    """Canonical form used for cache keys: NFC, trimmed, internal whitespace collapsed."""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text or "")).strip()
+
+
+class LLMCache:
+    """Exact-match cache of validated analyses, keyed by SHA-256 of model + prompt + message."""
 
-    return call_with_retries(_do_call)
+    def __init__(self, path: str = CACHE_DB):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(message: str) -> str:
+        payload = f"{MODEL}\0{FULL_SYSTEM}\0{SCHEMA_JSON}\0{normalize_message(message)}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+            (key, json.dumps(value, ensure_ascii=False)),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+async def embed_texts(texts: List[str]) -> "np.ndarray":
+    """Unit-normalized embeddings, requested EMBED_BATCH_SIZE texts at a time."""
+    vecs = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start : start + EMBED_BATCH_SIZE]
+
+        async def _do_call():
+            return await client.embeddings.create(model=EMBED_MODEL, input=batch)
+
+        resp = await call_with_retries(_do_call)
+        vecs.extend(d.embedding for d in resp.data)
+
+    arr = np.asarray(vecs, dtype="float32").reshape(-1, EMBED_DIM)
+    faiss.normalize_L2(arr)
+    return arr
+
+
+class SemanticCache:
+    """Nearest-neighbour cache: reuses the analysis of a previously seen, near-identical message."""
+
+    def __init__(self, prefix: str = SEMANTIC_CACHE_PREFIX):
+        # Results are only valid for the model, prompt, schema and embedding that produced them
+        config = f"{MODEL}\0{FULL_SYSTEM}\0{SCHEMA_JSON}\0{EMBED_MODEL}"
+        fingerprint = hashlib.sha256(config.encode("utf-8")).hexdigest()[:16]
+        index_path = self.index_path = f"{prefix}.{fingerprint}.faiss"
+        values_path = self.values_path = f"{prefix}.{fingerprint}.json"
+        self.hits = 0
+        self.dirty = False
+        if os.path.exists(index_path) and os.path.exists(values_path):
+            self.index = faiss.read_index(index_path)
+            with open(values_path, "r", encoding="utf-8") as f:
+                self.values: List[Dict[str, Any]] = json.load(f)
+        else:
+            self.index = faiss.IndexFlatIP(EMBED_DIM)
+            self.values = []
+
+    def lookup(self, vecs: "np.ndarray") -> List[Optional[Dict[str, Any]]]:
+        if self.index.ntotal == 0:
+            return [None] * len(vecs)
+        scores, ids = self.index.search(vecs, 1)
+        matches: List[Optional[Dict[str, Any]]] = []
+        for score, idx in zip(scores[:, 0], ids[:, 0]):
+            if idx >= 0 and score >= SEMANTIC_THRESHOLD:
+                self.hits += 1
+                matches.append(dict(self.values[idx]))
+            else:
+                matches.append(None)
+        return matches
+
+    def add(self, vecs: "np.ndarray", values: List[Dict[str, Any]]):
+        if len(values):
+            self.index.add(vecs)
+            self.values.extend(values)
+            self.dirty = True
+
+    def save(self):
+        """Rewrites the whole index, so call it once per run rather than per chunk."""
+        if not self.dirty:
+            return
+        faiss.write_index(self.index, self.index_path)
+        with open(self.values_path, "w", encoding="utf-8") as f:
+            json.dump(self.values, f, ensure_ascii=False)
+
+
+def resolve_analyses(
+    loop: asyncio.AbstractEventLoop,
+    cache: LLMCache,
+    messages: List[str],
+    realtime: bool,
+    sem: Optional[asyncio.Semaphore] = None,
+    semantic: Optional[SemanticCache] = None,
+) -> List[Any]:
+    """Serve cache hits, send each distinct miss to the API once, and cache the fresh results."""
+    results: List[Any] = [None] * len(messages)
+    pending: Dict[str, List[int]] = {}
+    for i, msg in enumerate(messages):
+        key = cache.key(msg)
+        hit = cache.get(key)
+        if hit is not None:
+            results[i] = hit
+        else:
+            pending.setdefault(key, []).append(i)
+
+    if not pending:
+        return results
+
+    vec_by_key: Dict[str, Any] = {}
+    if semantic is not None:
+        keys = list(pending)
+        texts = [normalize_message(messages[pending[k][0]]) for k in keys]
+        vecs = loop.run_until_complete(embed_texts(texts))
+        for key, vec, match in zip(keys, vecs, semantic.lookup(vecs)):
+            if match is None:
+                vec_by_key[key] = vec
+                continue
+            # Approximate answer: used for this run only, never stored in the exact-match cache
+            for i in pending.pop(key):
+                results[i] = match
+        if not pending:
+            return results
+
+    first_idx = [idxs[0] for idxs in pending.values()]
+    if realtime:
+        fresh = loop.run_until_complete(analyze_chunk([messages[i] for i in first_idx], sem))
+    else:
+        keys = list(pending)
+        by_key = loop.run_until_complete(run_batch(keys, [messages[i] for i in first_idx], cache))
+        fresh = [by_key[key] for key in keys]
+
+    new_vecs, new_values = [], []
+    for (key, idxs), analysis in zip(pending.items(), fresh):
+        if not isinstance(analysis, Exception):
+            cache.set(key, analysis)
+            if key in vec_by_key:
+                new_vecs.append(vec_by_key[key])
+                new_values.append(analysis)
+        for i in idxs:
+            results[i] = analysis
+    cache.commit()
+    if semantic is not None and new_values:
+        semantic.add(np.stack(new_vecs), new_values)
+    return results
+
+
+def iter_analyses(
+    loop: asyncio.AbstractEventLoop,
+    cache: LLMCache,
+    messages: List[str],
+    realtime: bool,
+    semantic: Optional[SemanticCache] = None,
+):
+    """Yield one analysis (or exception) per message, in input order."""
+    if realtime:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+        for start in range(0, len(messages), CHUNK_SIZE):
+            yield from resolve_analyses(
+                loop, cache, messages[start : start + CHUNK_SIZE], True, sem, semantic
+            )
+    else:
+        # Results of batches an interrupted run already paid for become cache hits below
+        loop.run_until_complete(recover_batches(cache))
+        yield from resolve_analyses(loop, cache, messages, False, semantic=semantic)
+
+
+def load_done_records(path: str) -> Dict[int, Dict[str, Any]]:
+    """Last record per RowId from a previous (possibly interrupted) run, for rows that succeeded."""
+    latest: Dict[int, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return latest
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                rec = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # a crash can leave a half-written last line
+            latest[rec["RowId"]] = rec
+    return {row_id: rec for row_id, rec in latest.items() if "error" not in rec}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Classify social media messages by topic and sentiment.")
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Call the Responses API directly instead of submitting an (async, cheaper) Batch API job.",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="Reuse results for near-duplicate messages via embedding similarity (requires faiss-cpu).",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print one line per row instead of a progress bar.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help=f"Ignore rows already in {OUTPUT_JSONL} and overwrite the outputs instead of resuming.",
+    )
+    return parser.parse_args()
 
 
 def main():
+    args = parse_args()
+
+    # Root stays at WARNING so httpx / openai don't log every request; only our own INFO lines show
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    logger.setLevel(logging.INFO)
+    logger.addFilter(RateLimitFilter(MAX_ERROR_LOGS_PER_MIN))
+
+    if args.semantic_cache and faiss is None:
+        raise ImportError("--semantic-cache requires faiss-cpu and numpy: pip install faiss-cpu numpy")
+
     if not os.path.exists(INPUT_CSV):
         raise FileNotFoundError(
             f"Cannot find {INPUT_CSV}. Put it in the same folder or update INPUT_CSV."
         )
 
-    df = pd.read_csv(INPUT_CSV)
+    # Multithreaded Arrow parser; columns stay Arrow-backed so the string ops below run natively
+    table = pacsv.read_csv(
+        INPUT_CSV,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        # Reddit posts contain line breaks inside quoted fields
+        parse_options=pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=pacsv.ConvertOptions(
+            # text/meta columns keep their raw text (no timestamp/number inference)
+            column_types={c: pa.string() for c in [TEXT_COL, *META_COLS]},
+            strings_can_be_null=True,
+        ),
+    )
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
 
     if TEXT_COL not in df.columns:
         raise ValueError(f"CSV must contain '{TEXT_COL}'. Found columns: {list(df.columns)}")
@@ -203,48 +897,117 @@ def main():
     df = df.reset_index(drop=True)
     df["RowId"] = df.index + 1
 
-    df[TEXT_COL] = df[TEXT_COL].astype(str)
-    df["__msg_clean"] = df[TEXT_COL].str.strip()
-    df = df[df["__msg_clean"].str.len() > 0].copy()
+    df[TEXT_COL] = df[TEXT_COL].fillna("")
+    df["__msg_clean"] = trim_column(df[TEXT_COL])
+    msg_len = df["__msg_clean"].str.len()  # Arrow utf8_length kernel, no per-row Python
 
-    total = len(df)
-    results = []
+    mask_has_signal = df["__msg_clean"].str.contains(
+        PRE_FILTER.pattern, case=False, regex=True, na=False
+    )
+    df["__prefiltered"] = ~mask_has_signal & (msg_len < PRE_FILTER_MIN_CHARS)
 
-    with open(OUTPUT_JSONL, "w", encoding="utf-8") as fout:
-        processed = 0
-        for _, row in df.iterrows():
-            processed += 1
-            row_id = int(row["RowId"])
-            msg = row["__msg_clean"]
+    # Resume: rows already written successfully by an earlier run are not redone
+    resume = not args.restart and os.path.exists(OUTPUT_JSONL)
+    done = load_done_records(OUTPUT_JSONL) if resume else {}
+    if done:
+        print(f"Resuming: {len(done)} rows already in {OUTPUT_JSONL}")
 
-            meta = {"RowId": row_id}
-            for c in META_COLS:
-                if c in df.columns and pd.notna(row.get(c)):
-                    meta[c] = row.get(c)
+    # All columns are assigned above, so the filtered frame can be a plain boolean-index view
+    keep = (msg_len > 0).to_numpy(dtype=bool) & ~df["RowId"].isin(list(done)).to_numpy(dtype=bool)
+    df = df.loc[keep]
+    to_llm = df[~df["__prefiltered"]]
+    prefiltered_analysis = validate_and_normalize(PRE_FILTER_RESULT)
 
-            try:
-                analysis = analyze_message(msg)
-                out_row = {**meta, "Message": row[TEXT_COL], **analysis}
-                print(
-                    f"[{processed}/{total}] RowId={row_id} "
-                    f"msg={msg}"
-                    f"topic={analysis['topic']} ({analysis['confidence']:.2f}) "
-                    f"newSentiment={analysis['newSentiment']} ({analysis['newSentimentConfidence']:.2f})"
-                )
-            except Exception as e:
-                out_row = {**meta, "Message": row[TEXT_COL], "error": str(e)}
-                print(f"[{processed}/{total}] RowId={row_id} ERROR: {e}")
-
-            fout.write(json.dumps(out_row, ensure_ascii=False) + "\n")
-            results.append(out_row)
-            time.sleep(SLEEP_BETWEEN_CALLS_SEC)
-
-    out_df = pd.DataFrame(results)
-    out_df.to_csv(OUTPUT_CSV, index=False, encoding="utf-8-sig")
-
-    pd.DataFrame(TOPICS).to_csv("topic_lookup.csv", index=False, encoding="utf-8-sig")
-
-    print(f"\nDone. Wrote {OUTPUT_JSONL}, {OUTPUT_CSV}, and topic_lookup.csv")
+    total = len(df)
+
+    # One event loop for the whole run so the async client's connection pool is reused
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    cache = LLMCache()
+    semantic = SemanticCache() if args.semantic_cache else None
+    analyses = iter_analyses(
+        loop,
+        cache,
+        to_llm["__msg_clean"].tolist(),
+        args.realtime,
+        semantic,
+    )
+
+    present_meta = [c for c in META_COLS if c in df.columns]
+    records = df[["RowId", TEXT_COL, "__msg_clean", "__prefiltered", *present_meta]].to_dict(
+        orient="records"
+    )
+
+    fields = ["RowId", *present_meta, "Message", *ANALYSIS_FIELDS, "error"]
+
+    if resume:
+        # Compact to one successful record per RowId (failed rows are retried below); the
+        # rename keeps the previous file intact if we're killed mid-rewrite
+        tmp_path = OUTPUT_JSONL + ".tmp"
+        with open(tmp_path, "wb", buffering=1 << 20) as f:
+            for done_row in done.values():
+                f.write(orjson.dumps(done_row) + b"\n")
+        os.replace(tmp_path, OUTPUT_JSONL)
+
+    # topics.jsonl is the source of truth; topics.csv is always rebuilt from it plus this run's rows
+    with open(OUTPUT_JSONL, "ab" if resume else "wb", buffering=1 << 20) as fout, open(
+        OUTPUT_CSV, "w", newline="", encoding="utf-8-sig"
+    ) as fcsv:
+        csv_out = csv.DictWriter(fcsv, fieldnames=fields, extrasaction="ignore")
+        csv_out.writeheader()
+        csv_out.writerows(done.values())
+        processed = 0
+        errors = 0
+        # Route log lines through tqdm.write so row errors don't garble the progress bar
+        with logging_redirect_tqdm():
+            for rec in tqdm(records, total=total, unit="row", disable=args.verbose):
+                analysis = dict(prefiltered_analysis) if rec["__prefiltered"] else next(analyses)
+                processed += 1
+                row_id = int(rec["RowId"])
+
+                meta = {"RowId": row_id}
+                for c in present_meta:
+                    v = rec[c]
+                    if v is not None and v is not pd.NA:  # Arrow nulls (None or pd.NA by pandas version)
+                        meta[c] = v
+
+                if isinstance(analysis, Exception):
+                    errors += 1
+                    out_row = {**meta, "Message": rec[TEXT_COL], "error": str(analysis)}
+                    logger.error(f"RowId={row_id}: {analysis}")
+                else:
+                    out_row = {**meta, "Message": rec[TEXT_COL], **analysis}
+                    if args.verbose:
+                        print(
+                            f"[{processed}/{total}] RowId={row_id} "
+                            f"msg={rec['__msg_clean']} "
+                            f"topic={analysis['topic']} ({analysis['confidence']:.2f}) "
+                            f"newSentiment={analysis['newSentiment']} ({analysis['newSentimentConfidence']:.2f})"
+                        )
+
+                fout.write(orjson.dumps(out_row) + b"\n")
+                csv_out.writerow(out_row)
+                if processed % CHUNK_SIZE == 0:
+                    # Bound what a hard kill can lose; JSONL first so it's never behind the CSV
+                    fout.flush()
+                    fcsv.flush()
+
+    loop.run_until_complete(client.close())
+    loop.close()
+    cache.close()
+    if semantic is not None:
+        semantic.save()
+    print(f"Errors: {errors} rows (see the 'error' column)")
+    print(f"Pre-filter: {total - len(to_llm)} rows skipped without an API call")
+    print(f"Cache: {cache.hits} hits, {cache.misses} misses")
+    if semantic is not None:
+        print(f"Semantic cache: {semantic.hits} near-duplicate hits")
+
+    # The lookup table only changes when TOPICS does, so skip the write if it's already current
+    if not os.path.exists(TOPIC_LOOKUP_CSV) or Path(TOPIC_LOOKUP_CSV).read_bytes() != TOPICS_CSV_BYTES:
+        Path(TOPIC_LOOKUP_CSV).write_bytes(TOPICS_CSV_BYTES)
+
+    print(f"\nDone. Wrote {OUTPUT_JSONL}, {OUTPUT_CSV}, and {TOPIC_LOOKUP_CSV}")
 
 
 if __name__ == "__main__":